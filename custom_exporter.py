@@ -1,73 +1,297 @@
+import asyncio
+import logging
+import os
+import re
 import time
 import threading
-import requests
-from datetime import datetime, timezone
+import httpx
+import numpy as np
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
 from typing import Optional, Tuple, Any, Dict, List
-from prometheus_client import start_http_server, Gauge, Counter, Summary
+from urllib.parse import urlencode
+from zoneinfo import ZoneInfo
+from prometheus_client import start_http_server, make_wsgi_app, multiprocess, Gauge, Counter, Histogram, CollectorRegistry, REGISTRY
 
 # -------- настройки --------
-SCRAPE_INTERVAL = 20
+# сколько /metrics ждёт обновления источников, сек; должно быть заметно меньше scrape_timeout
+# Prometheus (по умолчанию 10 с), иначе вместо последних значений scrape целиком падает по таймауту
+REFRESH_TIMEOUT = 5
 LAT, LON = 51.1694, 71.4491  # Astana (Asia/Almaty)
 
+# Запросы к API: (базовый url, query-параметры) — собираются один раз при импорте
+Request = Tuple[str, Dict[str, Any]]
+OM_WEATHER: Request = (
+    "https://api.open-meteo.com/v1/forecast",
+    {"latitude": LAT, "longitude": LON, "current": "temperature_2m,wind_speed_10m,relative_humidity_2m", "timezone": "auto"},
+)
+OM_AIR_CURRENT: Request = (
+    "https://air-quality-api.open-meteo.com/v1/air-quality",
+    {"latitude": LAT, "longitude": LON, "current": "pm10,pm2_5,us_aqi", "timezone": "auto"},
+)
+OM_AIR_HOURLY: Request = (
+    "https://air-quality-api.open-meteo.com/v1/air-quality",
+    {"latitude": LAT, "longitude": LON, "hourly": "pm10,pm2_5,us_aqi", "timezone": "auto"},
+)
+FX_LATEST: Request = ("https://api.frankfurter.app/latest", {"from": "USD", "to": "KZT,EUR"})
+# оба тикера одним запросом
+BINANCE_PRICES: Request = ("https://api.binance.com/api/v3/ticker/price", {"symbols": '["BTCUSDT","ETHUSDT"]'})
+
+logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(asctime)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+logger = logging.getLogger("custom-exporter")
+# httpx пишет INFO-строку на каждый запрос — оставляем от него только предупреждения
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("httpcore").setLevel(logging.WARNING)
+
 # -------- метрики --------
+# При PROMETHEUS_MULTIPROC_DIR (запуск под gunicorn, см. gunicorn.conf.py) метрики пишутся в общие файлы,
+# а multiprocess_mode задаёт, как склеивать гейджи воркеров: значения — по самому свежему, время — max.
 # Погода
-weather_temperature_c = Gauge("weather_temperature_c", "Air temperature at 2m (C)")
-weather_wind_speed_ms = Gauge("weather_wind_speed_ms", "Wind speed at 10m (m/s)")
-weather_humidity_percent = Gauge("weather_humidity_percent", "Relative humidity (%)")
+weather_temperature_c = Gauge("weather_temperature_c", "Air temperature at 2m (C)", multiprocess_mode="livemostrecent")
+weather_wind_speed_ms = Gauge("weather_wind_speed_ms", "Wind speed at 10m (m/s)", multiprocess_mode="livemostrecent")
+weather_humidity_percent = Gauge("weather_humidity_percent", "Relative humidity (%)", multiprocess_mode="livemostrecent")
 
 # Воздух
-air_pm10_ugm3 = Gauge("air_pm10_ugm3", "PM10 ug/m3")
-air_pm25_ugm3 = Gauge("air_pm25_ugm3", "PM2.5 ug/m3")
-air_us_aqi = Gauge("air_us_aqi", "US AQI")
+air_pm10_ugm3 = Gauge("air_pm10_ugm3", "PM10 ug/m3", multiprocess_mode="livemostrecent")
+air_pm25_ugm3 = Gauge("air_pm25_ugm3", "PM2.5 ug/m3", multiprocess_mode="livemostrecent")
+air_us_aqi = Gauge("air_us_aqi", "US AQI", multiprocess_mode="livemostrecent")
 
 # Валюты
-fx_usd_kzt = Gauge("fx_usd_kzt", "USD/KZT")
-fx_eur_kzt = Gauge("fx_eur_kzt", "EUR/KZT")
+fx_usd_kzt = Gauge("fx_usd_kzt", "USD/KZT", multiprocess_mode="livemostrecent")
+fx_eur_kzt = Gauge("fx_eur_kzt", "EUR/KZT", multiprocess_mode="livemostrecent")
+fx_rates_date_timestamp_seconds = Gauge(
+    "fx_rates_date_timestamp_seconds", "Publication date of current FX rates (unix time)", multiprocess_mode="max"
+)
+
+# Frankfurter (ECB) публикует курсы по будням около 16:00 CET
+FX_TZ = ZoneInfo("Europe/Berlin")
+FX_PUBLISH_HOUR = 16
+FX_RETRY_PERIOD = 60  # пока ни одного курса не получили, сек
+# Состояние FX: "date" -> дата последних полученных курсов
+_FX_STATE: Dict[str, date] = {}
 
 # Крипта
-crypto_btc_usd = Gauge("crypto_btc_usd", "BTC/USD")
-crypto_eth_usd = Gauge("crypto_eth_usd", "ETH/USD")
+crypto_btc_usd = Gauge("crypto_btc_usd", "BTC/USD", multiprocess_mode="livemostrecent")
+crypto_eth_usd = Gauge("crypto_eth_usd", "ETH/USD", multiprocess_mode="livemostrecent")
 
 # GitHub (метрики определены — при желании можно дописать сбор)
-github_repo_stars = Gauge("github_repo_stars", "GitHub repo stargazers count", ["repo"])
-github_repo_open_issues = Gauge("github_repo_open_issues", "GitHub repo open issues", ["repo"])
+github_repo_stars = Gauge("github_repo_stars", "GitHub repo stargazers count", ["repo"], multiprocess_mode="livemostrecent")
+github_repo_open_issues = Gauge("github_repo_open_issues", "GitHub repo open issues", ["repo"], multiprocess_mode="livemostrecent")
 
 # Служебные
 api_success_total = Counter("api_success_total", "Successful API scrapes", ["api"])
 api_fail_total = Counter("api_fail_total", "Failed API scrapes", ["api"])
-api_latency_seconds = Summary("api_latency_seconds", "Latency for API calls in seconds", ["api"])
-api_last_scrape_timestamp_seconds = Gauge("api_last_scrape_timestamp_seconds", "Last scrape unix time", ["api"])
+api_latency_seconds = Histogram(
+    "api_latency_seconds",
+    "Latency for API calls in seconds; cache=hit for responses still fresh by max-age, miss for upstream requests",
+    ["api", "cache"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10),
+)
+api_last_scrape_timestamp_seconds = Gauge("api_last_scrape_timestamp_seconds", "Last scrape unix time", ["api"], multiprocess_mode="max")
+api_not_modified_total = Counter("api_not_modified_total", "API responses answered with 304 Not Modified", ["api"])
+api_cache_hits_total = Counter("api_cache_hits_total", "API calls answered from a response still fresh by Cache-Control max-age", ["api"])
+pollers_in_progress = Gauge("pollers_in_progress", "Pollers currently in flight", multiprocess_mode="livesum")
+
+# дочерние метрики по api считаем один раз, а не .labels() на каждом опросе
+M = {
+    name: {
+        "success": api_success_total.labels(name),
+        "fail": api_fail_total.labels(name),
+        "not_modified": api_not_modified_total.labels(name),
+        "latency_hit": api_latency_seconds.labels(name, "hit"),
+        "latency_miss": api_latency_seconds.labels(name, "miss"),
+        "cache_hits": api_cache_hits_total.labels(name),
+        "ts": api_last_scrape_timestamp_seconds.labels(name),
+    }
+    for name in ("openmeteo_weather", "openmeteo_air", "frankfurter", "binance", "stackoverflow")
+}
 
 # Прочее
-session = requests.Session()
-session.headers.update({"User-Agent": "custom-exporter/1.1"})
+# AsyncClient привязан к event loop, поэтому создаётся внутри него (см. _refresh_stale)
+session: Optional[httpx.AsyncClient] = None
+
+# пул соединений и повторы на временные ошибки апстрима (только GET)
+POOL_MAX_CONNECTIONS = 64
+POOL_MAX_KEEPALIVE = 32
+REQUEST_TIMEOUT = 10  # на одну попытку, сек
+RETRY_TOTAL = 2
+RETRY_DEADLINE = 15  # на все попытки вместе, сек: обновление укладывается в интервал scrape (20 с)
+RETRY_BACKOFF = 0.3
+RETRY_STATUSES = frozenset((500, 502, 503, 504))
+
+
+def _make_session() -> httpx.AsyncClient:
+    # HTTP/2: запросы к одному хосту мультиплексируются в одном соединении
+    return httpx.AsyncClient(
+        http2=True,
+        timeout=REQUEST_TIMEOUT,
+        headers={"User-Agent": "custom-exporter/1.1"},
+        limits=httpx.Limits(
+            max_connections=POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=POOL_MAX_KEEPALIVE,
+            keepalive_expiry=60,
+        ),
+        follow_redirects=True,
+    )
+
 
-# StackOverflow (раз в 10 минут)
-LAST_SO_POLL = 0
-SO_MIN_PERIOD = 600
-so_tag_count = Gauge("so_tag_count", "StackOverflow tag usage count", ["tag"])
+# StackOverflow
+so_tag_count = Gauge("so_tag_count", "StackOverflow tag usage count", ["tag"], multiprocess_mode="livemostrecent")
+SO_TAGS = ("tensorflow", "linux")
+SO_CHILDREN = {t: so_tag_count.labels(tag=t) for t in SO_TAGS}
+SO_TAGS_INFO: Request = (f"https://api.stackexchange.com/2.3/tags/{';'.join(SO_TAGS)}/info", {"site": "stackoverflow"})
+
+# Ограничители частоты опроса: ключ -> time.monotonic() последнего срабатывания
+_GATES: Dict[str, float] = {}
+
+# HTTP-кэширование (RFC 7234): ключ запроса (см. _cache_key) -> {"etag", "last_modified", "expires", "data"}
+# трогается только из потока event loop'а, поэтому без блокировки
+_VALIDATORS: Dict[str, Dict[str, Any]] = {}
+_MAX_AGE_RE = re.compile(r"(?:^|,)\s*max-age\s*=\s*(\d+)", re.IGNORECASE)
 
 
 # -------- утилиты --------
 def log_info(msg: str):
-    print(f"[INFO] {time.strftime('%Y-%m-%d %H:%M:%S')} {msg}", flush=True)
+    logger.info(msg)
 
 
 def log_warn(msg: str):
-    print(f"[WARN] {time.strftime('%Y-%m-%d %H:%M:%S')} {msg}", flush=True)
+    logger.warning(msg)
+
+
+def _describe_error(err: Exception) -> str:
+    """Однострочное описание ошибки запроса (str у HTTPStatusError занимает две строки)."""
+    if isinstance(err, httpx.HTTPStatusError):
+        return f"HTTP {err.response.status_code} for {err.request.url}"
+    lines = str(err).splitlines()
+    return lines[0] if lines else repr(err)
+
+
+def gate(key: str, period: float) -> bool:
+    """True не чаще раза в period секунд на ключ (монотонные часы, не боятся перевода времени)."""
+    now = time.monotonic()
+    last = _GATES.get(key)
+    if last is not None and now - last < period:
+        return False
+    _GATES[key] = now
+    return True
+
+
+async def _get_json(url: str, **kwargs) -> Tuple[int, Any, Any]:
+    """
+    GET с повторами на 5xx из RETRY_STATUSES и ошибки соединения/таймауты,
+    экспоненциальная пауза RETRY_BACKOFF * 2^attempt между попытками.
+    Все попытки вместе укладываются в RETRY_DEADLINE: таймаут попытки урезается
+    до остатка бюджета, а повтор, на который бюджета не хватает, не делается.
+    Возвращает (status, headers, json); на 304 тела нет и json = None.
+    """
+    deadline = time.monotonic() + RETRY_DEADLINE
+    for attempt in range(RETRY_TOTAL + 1):
+        pause = RETRY_BACKOFF * (2 ** attempt)
+        timeout = min(REQUEST_TIMEOUT, deadline - time.monotonic())
+        try:
+            r = await session.get(url, timeout=timeout, **kwargs)
+        except httpx.TransportError:
+            if attempt == RETRY_TOTAL or deadline - time.monotonic() - pause < 1:
+                raise
+        else:
+            if r.status_code == 304:
+                return r.status_code, r.headers, None
+            if (
+                r.status_code not in RETRY_STATUSES
+                or attempt == RETRY_TOTAL
+                or deadline - time.monotonic() - pause < 1
+            ):
+                r.raise_for_status()
+                return r.status_code, r.headers, orjson.loads(r.content)
+        await asyncio.sleep(pause)
+
+
+def _cache_key(url: str, params: Dict[str, Any]) -> str:
+    # параметры сортируем, чтобы ключ не зависел от их порядка
+    return f"{url}?{urlencode(sorted(params.items()))}" if params else url
+
+
+def _store_validators(key: str, headers: Any, data: Any, now: float, prev: Optional[Dict[str, Any]] = None):
+    """
+    Запоминаем ETag/Last-Modified и срок свежести из Cache-Control: max-age (минус Age).
+    На 304 сервер может не повторять валидаторы — тогда берём прежние из prev.
+    """
+    prev = prev or {}
+    cc = headers.get("Cache-Control", "")
+    if "no-store" in cc.lower():
+        _VALIDATORS.pop(key, None)
+        return
+
+    expires = 0.0
+    m = _MAX_AGE_RE.search(cc)
+    if m and "no-cache" not in cc.lower():
+        age = headers.get("Age", "0")
+        expires = now + int(m.group(1)) - (int(age) if age.isdigit() else 0)
 
+    etag = headers.get("ETag") or prev.get("etag")
+    last_modified = headers.get("Last-Modified") or prev.get("last_modified")
+    if etag or last_modified or expires > now:
+        _VALIDATORS[key] = {"etag": etag, "last_modified": last_modified, "expires": expires, "data": data}
+    else:
+        _VALIDATORS.pop(key, None)
+
+
+def _record_hit(api_name: str, start: float) -> float:
+    latency = time.perf_counter() - start
+    M[api_name]["latency_hit"].observe(latency)
+    M[api_name]["cache_hits"].inc()
+    return latency
+
+
+def _record_miss(api_name: str, start: float) -> float:
+    latency = time.perf_counter() - start
+    M[api_name]["latency_miss"].observe(latency)
+    M[api_name]["ts"].set(time.time())
+    return latency
+
+
+async def timed_get(
+    api_name: str,
+    request: Request,
+    **kwargs,
+) -> Tuple[Optional[Dict[str, Any]], float, Optional[Exception]]:
+    """
+    GET (url, params) + JSON с учётом метрик успеха/ошибок и HTTP-кэширования:
+    свежий по max-age ответ не запрашиваем вовсе,
+    иначе шлём If-None-Match / If-Modified-Since и на 304 берём прошлый JSON.
+    Частоту повторных запросов ограничивают gate() в сборщиках, отдельного TTL-кэша нет.
+    Latency и время последнего обращения к API пишем здесь же: ответы из кэша идут
+    в отдельную серию cache="hit" и не размывают реальную задержку апстрима.
+    """
+    start = time.perf_counter()  # для latency: монотонно и с высоким разрешением
+    now = time.time()  # для max-age — обычное unix-время
+    url, params = request
+    key = _cache_key(url, params)
+
+    validators = _VALIDATORS.get(key)
+    if validators is not None and validators["expires"] > now:
+        return validators["data"], _record_hit(api_name, start), None
+    if validators is not None:
+        headers = dict(kwargs.pop("headers", None) or {})
+        if validators["etag"]:
+            headers["If-None-Match"] = validators["etag"]
+        if validators["last_modified"]:
+            headers["If-Modified-Since"] = validators["last_modified"]
+        kwargs["headers"] = headers
 
-def timed_get(api_name: str, url: str, **kwargs) -> Tuple[Optional[Dict[str, Any]], float, Optional[Exception]]:
-    start = time.time()
     try:
-        r = session.get(url, timeout=10, **kwargs)
-        r.raise_for_status()
-        data = r.json()
-        api_success_total.labels(api_name).inc()
-        return data, time.time() - start, None
+        status, resp_headers, data = await _get_json(url, params=params, **kwargs)
+        if status == 304 and validators is not None:
+            M[api_name]["not_modified"].inc()
+            data = validators["data"]
+        _store_validators(key, resp_headers, data, time.time(), validators)
+        M[api_name]["success"].inc()
+        return data, _record_miss(api_name, start), None
     except Exception as e:
-        api_fail_total.labels(api_name).inc()
-        return None, time.time() - start, e
+        M[api_name]["fail"].inc()
+        return None, _record_miss(api_name, start), e
 
 
 def _parse_iso_ts(ts: str) -> Optional[datetime]:
@@ -76,6 +300,15 @@ def _parse_iso_ts(ts: str) -> Optional[datetime]:
     Возвращаем aware datetime в UTC.
     """
     try:
+        # быстрый путь под формат hourly Open-Meteo 'YYYY-MM-DDTHH:MM' (без оффсета — трактуем как UTC)
+        if len(ts) == 16 and ts[10] == "T":
+            try:
+                return datetime(
+                    int(ts[0:4]), int(ts[5:7]), int(ts[8:10]), int(ts[11:13]), int(ts[14:16]), tzinfo=timezone.utc
+                )
+            except ValueError:
+                pass
+
         # Python 3.11: datetime.fromisoformat понимает 'YYYY-MM-DDTHH:MM' и с оффсетом
         dt = datetime.fromisoformat(ts.replace("Z", "+00:00"))
         if dt.tzinfo is None:
@@ -89,48 +322,58 @@ def _parse_iso_ts(ts: str) -> Optional[datetime]:
         return None
 
 
-def _last_past_value(hourly: Dict[str, List[Any]], key: str) -> Optional[float]:
+def _last_past_index(times: Any) -> int:
+    """
+    Индекс наибольшего таймстампа в hourly["time"], не превосходящего "сейчас" (UTC);
+    -1, если такого нет. Массив разбираем разом через numpy и ищем бинарным поиском.
+    """
+    if not isinstance(times, list) or not times:
+        return -1
+    try:
+        times_np = np.array(times, dtype="datetime64[m]")
+    except ValueError:
+        # нестандартный формат — разбираем поэлементно, идём с конца
+        now_utc = datetime.now(timezone.utc)
+        for i in range(len(times) - 1, -1, -1):
+            dt = _parse_iso_ts(times[i])
+            if dt is not None and dt <= now_utc:
+                return i
+        return -1
+
+    now = np.datetime64(datetime.now(timezone.utc).replace(tzinfo=None), "m")
+    return int(np.searchsorted(times_np, now, side="right")) - 1
+
+
+def _last_past_value(hourly: Dict[str, List[Any]], key: str, idx: int) -> Optional[float]:
     """
     Берем из hourly массивов Open-Meteo значение 'key' с таймстампом, который
-    наибольший, но не превосходит "сейчас" (UTC). Если ничего не нашли — None.
+    наибольший, но не превосходит "сейчас" (UTC). idx — результат _last_past_index
+    для hourly["time"]; пропуски (None) обходим назад. Если ничего не нашли — None.
     """
     times = hourly.get("time")
     values = hourly.get(key)
     if not isinstance(times, list) or not isinstance(values, list) or len(times) != len(values) or not times:
         return None
 
-    now_utc = datetime.now(timezone.utc)
-
-    # идём с конца, ищем первое прошедшее
-    for i in range(len(times) - 1, -1, -1):
-        dt = _parse_iso_ts(times[i])
-        if dt is None:
-            continue
-        if dt <= now_utc:
-            v = values[i]
-            if v is not None:
-                try:
-                    return float(v)
-                except Exception:
-                    return None
+    for i in range(idx, -1, -1):
+        v = values[i]
+        if v is not None:
+            try:
+                return float(v)
+            except Exception:
+                return None
     return None
 
 
 # -------- сборщики --------
-def poll_openmeteo_weather():
+async def poll_openmeteo_weather():
     api = "openmeteo_weather"
-    url = (
-        "https://api.open-meteo.com/v1/forecast"
-        f"?latitude={LAT}&longitude={LON}"
-        "&current=temperature_2m,wind_speed_10m,relative_humidity_2m"
-        "&timezone=auto"
-    )
-    data, latency, err = timed_get(api, url)
-    api_latency_seconds.labels(api).observe(latency)
-    api_last_scrape_timestamp_seconds.labels(api).set(time.time())
+    if not gate(api, 300):
+        return
+    data, _, err = await timed_get(api, OM_WEATHER)
     if err or not data or "current" not in data:
         if err:
-            log_warn(f"{api}: {err}")
+            log_warn(f"{api}: {_describe_error(err)}")
         return
 
     c = data["current"]
@@ -146,22 +389,17 @@ def poll_openmeteo_weather():
         log_warn(f"{api}: parse current failed: {e}")
 
 
-def poll_openmeteo_air():
+async def poll_openmeteo_air():
     """
     1) Сначала пробуем current=pm10,pm2_5,us_aqi (если у API доступно).
     2) Если нет current — берём hourly и выбираем ближайшее прошедшее значение (не будущее!).
     """
     api = "openmeteo_air"
+    if not gate(api, 600):
+        return
 
     # --- попытка current ---
-    url_current = (
-        "https://air-quality-api.open-meteo.com/v1/air-quality"
-        f"?latitude={LAT}&longitude={LON}"
-        "&current=pm10,pm2_5,us_aqi&timezone=auto"
-    )
-    data, latency, err = timed_get(api, url_current)
-    api_latency_seconds.labels(api).observe(latency)
-    api_last_scrape_timestamp_seconds.labels(api).set(time.time())
+    data, _, err = await timed_get(api, OM_AIR_CURRENT)
 
     if not err and data and "current" in data:
         c = data["current"]
@@ -178,25 +416,19 @@ def poll_openmeteo_air():
             # пойдём в hourly как fallback
 
     # --- fallback: hourly ---
-    url_hourly = (
-        "https://air-quality-api.open-meteo.com/v1/air-quality"
-        f"?latitude={LAT}&longitude={LON}"
-        "&hourly=pm10,pm2_5,us_aqi&timezone=auto"
-    )
-    data, latency, err = timed_get(api, url_hourly)
-    api_latency_seconds.labels(api).observe(latency)
-    api_last_scrape_timestamp_seconds.labels(api).set(time.time())
+    data, _, err = await timed_get(api, OM_AIR_HOURLY)
 
     if err or not data or "hourly" not in data:
         if err:
-            log_warn(f"{api}: {err}")
+            log_warn(f"{api}: {_describe_error(err)}")
         return
 
     h = data["hourly"]
     try:
-        v_pm10 = _last_past_value(h, "pm10")
-        v_pm25 = _last_past_value(h, "pm2_5")
-        v_aqi = _last_past_value(h, "us_aqi")
+        idx = _last_past_index(h.get("time"))
+        v_pm10 = _last_past_value(h, "pm10", idx)
+        v_pm25 = _last_past_value(h, "pm2_5", idx)
+        v_aqi = _last_past_value(h, "us_aqi", idx)
 
         if v_pm10 is not None:
             air_pm10_ugm3.set(v_pm10)
@@ -208,97 +440,191 @@ def poll_openmeteo_air():
         log_warn(f"{api}: parse hourly failed: {e}")
 
 
-def poll_fx():
+def _fx_expected_date() -> date:
+    """Дата самых свежих курсов, которые уже должны быть опубликованы."""
+    now = datetime.now(FX_TZ)
+    d = now.date()
+    if now.hour < FX_PUBLISH_HOUR:
+        d -= timedelta(days=1)
+    while d.weekday() >= 5:
+        d -= timedelta(days=1)
+    return d
+
+
+def _have_last_value() -> bool:
+    return "date" in _FX_STATE
+
+
+async def poll_fx():
     api = "frankfurter"
-    url = "https://api.frankfurter.app/latest?from=USD&to=KZT,EUR"
-    data, latency, err = timed_get(api, url)
-    api_latency_seconds.labels(api).observe(latency)
-    api_last_scrape_timestamp_seconds.labels(api).set(time.time())
+    # курсы этого дня уже есть — до следующей публикации не ходим; иначе не чаще раза в час
+    # (праздники ECB); пока ни одного значения нет — не чаще раза в FX_RETRY_PERIOD
+    if _have_last_value():
+        if _FX_STATE["date"] >= _fx_expected_date() or not gate(api, 3600):
+            return
+    elif not gate(api, FX_RETRY_PERIOD):
+        return
+    data, _, err = await timed_get(api, FX_LATEST)
     if err or not data or "rates" not in data:
         if err:
-            log_warn(f"{api}: {err}")
+            log_warn(f"{api}: {_describe_error(err)}")
         return
     try:
         rates = data["rates"]
+        got_rate = False
         if "KZT" in rates and rates["KZT"] is not None:
             fx_usd_kzt.set(float(rates["KZT"]))
+            got_rate = True
         if "EUR" in rates and rates["EUR"] is not None:
             fx_eur_kzt.set(float(rates["EUR"]))
+            got_rate = True
+        if not got_rate:
+            # дату не запоминаем, иначе опрос встанет до следующей публикации без единого значения
+            log_warn(f"{api}: no KZT/EUR in rates")
+            return
+        rates_date = date.fromisoformat(data["date"]) if data.get("date") else _fx_expected_date()
+        if rates_date != _FX_STATE.get("date"):
+            _FX_STATE["date"] = rates_date
+            fx_rates_date_timestamp_seconds.set(
+                datetime(rates_date.year, rates_date.month, rates_date.day, tzinfo=timezone.utc).timestamp()
+            )
     except Exception as e:
         log_warn(f"{api}: parse failed: {e}")
 
 
-def poll_crypto():
+async def poll_crypto():
     api = "binance"
-    btc, l1, e1 = timed_get(api, "https://api.binance.com/api/v3/ticker/price?symbol=BTCUSDT")
-    api_latency_seconds.labels(api).observe(l1)
-    api_last_scrape_timestamp_seconds.labels(api).set(time.time())
-
-    eth, l2, e2 = timed_get(api, "https://api.binance.com/api/v3/ticker/price?symbol=ETHUSDT")
-    api_latency_seconds.labels(api).observe(l2)
-    api_last_scrape_timestamp_seconds.labels(api).set(time.time())
-
-    if e1:
-        log_warn(f"{api} BTC: {e1}")
-    if e2:
-        log_warn(f"{api} ETH: {e2}")
+    if not gate(api, 15):
+        return
+    data, _, err = await timed_get(api, BINANCE_PRICES)
+    if err or not isinstance(data, list):
+        if err:
+            log_warn(f"{api}: {_describe_error(err)}")
+        return
 
+    gauges = {"BTCUSDT": crypto_btc_usd, "ETHUSDT": crypto_eth_usd}
     try:
-        if btc and "price" in btc and btc["price"] is not None:
-            crypto_btc_usd.set(float(btc["price"]))
-        if eth and "price" in eth and eth["price"] is not None:
-            crypto_eth_usd.set(float(eth["price"]))
+        for item in data:
+            g = gauges.get(item.get("symbol"))
+            if g is not None and item.get("price") is not None:
+                g.set(float(item["price"]))
     except Exception as e:
         log_warn(f"{api}: parse failed: {e}")
 
 
-def poll_stackoverflow():
-    global LAST_SO_POLL
-    if time.time() - LAST_SO_POLL < SO_MIN_PERIOD:
-        return
-    LAST_SO_POLL = time.time()
-
+async def poll_stackoverflow():
     api = "stackoverflow"
-    tags = ["tensorflow", "linux"]
-    url = f"https://api.stackexchange.com/2.3/tags/{';'.join(tags)}/info?site=stackoverflow"
-
-    data, latency, err = timed_get(api, url)
-    api_latency_seconds.labels(api).observe(latency)
-    api_last_scrape_timestamp_seconds.labels(api).set(time.time())
+    if not gate(api, 600):
+        return
+    data, _, err = await timed_get(api, SO_TAGS_INFO)
     if err or not data or "items" not in data:
         if err:
-            log_warn(f"{api}: {err}")
+            log_warn(f"{api}: {_describe_error(err)}")
         return
 
     try:
         for item in data["items"]:
-            name = item.get("name")
+            child = SO_CHILDREN.get(item.get("name"))
             cnt = item.get("count")
-            if name and cnt is not None:
-                so_tag_count.labels(tag=name).set(float(cnt))
+            if child is not None and cnt is not None:
+                child.set(float(cnt))
     except Exception as e:
         log_warn(f"{api}: parse failed: {e}")
 
 
-def loop():
-    while True:
-        try:
-            poll_openmeteo_weather()
-            poll_openmeteo_air()
-            poll_fx()
-            poll_crypto()
-            poll_stackoverflow()
-        except Exception as e:
+# -------- обновление по запросу Prometheus --------
+# каждый сборщик сам решает через gate(), пора ли ходить в свой API
+_POLLERS = (poll_openmeteo_weather, poll_openmeteo_air, poll_fx, poll_crypto, poll_stackoverflow)
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+_refresh_task: Optional[asyncio.Future] = None
+
+# блокирующие вызовы event loop'а (getaddrinfo при установке соединений и т.п.) идут в этот пул
+EXEC = ThreadPoolExecutor(max_workers=6, thread_name_prefix="poll")
+
+
+def _ensure_loop() -> asyncio.AbstractEventLoop:
+    """Event loop в фоновом потоке; на нём живут session и все сборщики."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop.set_default_executor(EXEC)
+            threading.Thread(target=_loop.run_forever, name="poll-loop", daemon=True).start()
+    return _loop
+
+
+async def _tracked(poller):
+    with pollers_in_progress.track_inprogress():
+        await poller()
+
+
+async def _refresh_stale():
+    global session
+    if session is None:
+        session = _make_session()
+
+    # все источники независимы — опрашиваем параллельно, обновление длится как самый медленный запрос
+    results = await asyncio.gather(*(_tracked(poller) for poller in _POLLERS), return_exceptions=True)
+    for res in results:
+        if isinstance(res, Exception):
             # чтобы никогда не падать из-за неожиданного исключения
-            log_warn(f"main loop error: {e}")
-        time.sleep(SCRAPE_INTERVAL)
+            log_warn(f"refresh error: {res}")
+
+
+async def _refresh():
+    # параллельные scrape'ы ждут уже идущее обновление, а не запускают своё
+    global _refresh_task
+    if _refresh_task is None or _refresh_task.done():
+        _refresh_task = asyncio.ensure_future(_refresh_stale())
+    await asyncio.shield(_refresh_task)
+
+
+def refresh_if_stale():
+    fut = asyncio.run_coroutine_threadsafe(_refresh(), _ensure_loop())
+    try:
+        fut.result(timeout=REFRESH_TIMEOUT)
+    except Exception as e:
+        # отдаём последние известные значения, обновление доедет к следующему scrape
+        log_warn(f"refresh failed: {e!r}")
+
+
+class RefreshingCollector:
+    """
+    Обёртка над реестром метрик: перед каждой отдачей /metrics обновляет
+    устаревшие источники, так что апстримы опрашиваются только пока нас скрейпят.
+    """
+
+    def __init__(self, source: CollectorRegistry):
+        self._source = source
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        refresh_if_stale()
+        yield from self._source.collect()
+
+
+def _metrics_source() -> CollectorRegistry:
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return REGISTRY
+    source = CollectorRegistry()
+    multiprocess.MultiProcessCollector(source)
+    return source
+
+
+registry = CollectorRegistry()
+registry.register(RefreshingCollector(_metrics_source()))
+
+# WSGI-приложение для многопроцессного режима: gunicorn -c gunicorn.conf.py custom_exporter:app
+app = make_wsgi_app(registry)
 
 
 if __name__ == "__main__":
     log_info("Starting custom-exporter on :8000")
-    start_http_server(8000)
-    t = threading.Thread(target=loop, daemon=True)
-    t.start()
+    start_http_server(8000, registry=registry)
     # «держим» процесс живым
     while True:
         time.sleep(3600)
@@ -0,0 +1,16 @@
+# Многопроцессный запуск экспортера:
+#   rm -rf /tmp/prom && mkdir -p /tmp/prom
+#   PROMETHEUS_MULTIPROC_DIR=/tmp/prom gunicorn -c gunicorn.conf.py custom_exporter:app
+# Каталог должен быть пустым при старте — иначе подхватятся метрики прошлого запуска.
+import os
+
+from prometheus_client import multiprocess
+
+bind = "0.0.0.0:8000"
+# у каждого воркера свои gate(), так что N воркеров ходят в апстримы в N раз чаще
+workers = int(os.environ.get("EXPORTER_WORKERS", "2"))
+
+
+def child_exit(server, worker):
+    # убираем live-гейджи завершившегося воркера из общей выдачи
+    multiprocess.mark_process_dead(worker.pid)